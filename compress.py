@@ -1,55 +1,224 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import zlib
 import lzma
+import numpy as np
 
-def compress_lzma_len(s):
-    """Compress a byte string using LZMA, maximum compression, no header or checksum.
+try:
+    from isal import isal_zlib
+    isal_available = True
+except ImportError:
+    isal_available = False
+
+try:
+    import zstandard
+    zstd_available = True
+except ImportError:
+    zstd_available = False
+
+# zstandard compressors must not be shared between threads
+_zstd_local = threading.local()
+
+# compressors are fed this many bytes at a time
+_CHUNK = 1 << 16
+
+def _stream_len(co, s, flush=True):
+    """Feed the byte string s to the compressor object co in chunks,
+    and return the total length of the output, so that the compressed
+    string is never held in memory. If flush is False, the compressor
+    is left open to take more data."""
+    view = memoryview(s)
+    n = 0
+    for i in range(0, len(view), _CHUNK):
+        n += len(co.compress(view[i:i+_CHUNK]))
+    if flush:
+        n += len(co.flush())
+    return n
+
+def compress_lzma_len(s, use_delta=False):
+    """Compress a byte string using LZMA, no header or checksum.
+    If use_delta is True, delta-encode the bytes first.
     Return the length of the compressed string."""
-    filters = [
-        {"id": lzma.FILTER_DELTA, "dist": 5},
-        {"id": lzma.FILTER_LZMA2, "preset": 7 | lzma.PRESET_EXTREME},
-    ]
-    return len(lzma.compress(s, format=lzma.FORMAT_RAW, filters=filters))
+    filters = [{"id": lzma.FILTER_LZMA2, "preset": 6}]
+    if use_delta:
+        filters.insert(0, {"id": lzma.FILTER_DELTA, "dist": 5})
+    return _stream_len(lzma.LZMACompressor(format=lzma.FORMAT_RAW, filters=filters), s)
 
 def compress_zlib_len(s):
     """Compress a byte string s using zlib, maximum compression, no header or checksum. 
     Return the length of the compressed string."""
-    return len(zlib.compress(s, wbits=-15, level=9))
+    return _stream_len(zlib.compressobj(level=9, wbits=-15), s)
+
+def compress_isal_len(s):
+    """Compress a byte string s using ISA-L's deflate (level 3, its maximum),
+    no header or checksum. Much faster than zlib, but the output is several 
+    times larger on structured code streams, so ratios are not comparable
+    with "zlib" mode. Requires the isal package.
+    Return the length of the compressed string."""
+    return _stream_len(isal_zlib.compressobj(level=isal_zlib.ISAL_BEST_COMPRESSION, wbits=-15), s)
 
-def ncd(a, b):
-    """Compute the normalised compression distance between a and b
+def compress_zstd_len(s):
+    """Compress a byte string s using zstd (level 3), no content size or checksum.
+    Requires the zstandard package.
+    Return the length of the compressed string."""
+    cctx = getattr(_zstd_local, "cctx", None)
+    if cctx is None:
+        cctx = _zstd_local.cctx = zstandard.ZstdCompressor(level=3, write_content_size=False, write_checksum=False)
+    # one-shot, so zstd can tune its parameters to the input size
+    return len(cctx.compress(s))
+
+def _make_co():
+    """Return a zlib compressor, maximum compression, no header or checksum.
+    These can be copied mid-stream."""
+    # Copying a pristine template compressor is slower than making a new one
+    # (deflateCopy duplicates the whole window and hash table), so only
+    # copy once there is a shared prefix worth keeping.
+    return zlib.compressobj(level=9, wbits=-15)
+
+def _concat_compress_lens(a, bs):
+    """Compress a+b for each byte string b in bs, sharing
+    the compressor state after a, so the prefix is only compressed once.
+    Return the list of compressed lengths."""
+    co = _make_co()
+    head = _stream_len(co, a, flush=False)
+    lens = []
+    for b in bs:
+        lens.append(head + _stream_len(co.copy(), b))
+    return lens
+
+def ncd(a, b, mode="zlib"):
+    """Compute the normalised compression distance between 
+    the integer sequences a and b
     https://en.wikipedia.org/wiki/Normalized_compression_distance
     """
-    z_ab = compress_len(a+b)
-    z_a = compress_len(a)
-    z_b = compress_len(b)
+    a, b = np.ravel(a), np.ravel(b)
+    # a, b and a+b must all be encoded with the same width
+    dtype = _byte_dtype([a, b])
+    s_a = integer_sequence_to_bytes(a, dtype)
+    s_b = integer_sequence_to_bytes(b, dtype)
+    if mode=="zlib":
+        z_a, z_ab = _concat_compress_lens(s_a, [b'', s_b])
+        z_b, = _concat_compress_lens(s_b, [b''])
+    else:
+        z_ab = _compress_bytes_len(s_a + s_b, mode)
+        z_a = _compress_bytes_len(s_a, mode)
+        z_b = _compress_bytes_len(s_b, mode)
     return (z_ab - min(z_a, z_b)) / max(z_a, z_b)
 
-def integer_sequence_to_bytes(ls):
+def ncd_matrix(items, mode="zlib", max_workers=None):
+    """Compute the matrix of normalised compression distances 
+    between every pair of integer sequences in items, 
+    D[i,j] = ncd(items[i], items[j]) (all items are encoded
+    with the same width, so this can differ slightly from ncd() 
+    if only some items need two bytes per value).
+    Each item is compressed on its own only once, and rows
+    are computed in parallel on a thread pool of max_workers threads.
+    """
+    items = [np.ravel(x) for x in items]
+    if len(items)==0:
+        return np.zeros((0, 0))
+    dtype = _byte_dtype(items)
+    bs = [integer_sequence_to_bytes(x, dtype) for x in items]
+    if mode!="zlib":
+        compress = _compressor(mode)
+
+    def row(i):
+        """Return C(items[i] + items[j]) for every j, and C(items[i])"""
+        if mode=="zlib":
+            # C(items[i]) comes for free from the shared prefix
+            z_i, *z_ij = _concat_compress_lens(bs[i], [b''] + bs)
+        else:
+            z_i = compress(bs[i])
+            z_ij = [compress(bs[i] + b) for b in bs]
+        return z_ij, z_i
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        rows = list(pool.map(row, range(len(bs))))
+    z_ij = np.array([r[0] for r in rows])
+    z = np.array([r[1] for r in rows])
+    return (z_ij - np.minimum.outer(z, z)) / np.maximum.outer(z, z)
+
+def _byte_dtype(arrs):
+    """Return the narrowest dtype integer_sequence_to_bytes
+    can use for all of the integer arrays in arrs.
+    Raise ValueError if any value is outside 0-65535."""
+    mn = min((arr.min() for arr in arrs if arr.size), default=0)
+    mx = max((arr.max() for arr in arrs if arr.size), default=0)
+    if mn < 0 or mx > 65535:
+        raise ValueError(f"Integer sequences must be in the range 0-65535 (got min {mn}, max {mx})")
+    return "u1" if mx < 256 else ">u2"
+
+def integer_sequence_to_bytes(ls, dtype=None):
     """Encode a sequence of integers as a byte string. 
     If all integers are in the range 0-255, each is encoded as a byte;
-    if in range 0-65535 as byte pairs, in the platform endianness."""
-    
-    if len(ls)==0 or max(ls)<255:
-        s = [int(l).to_bytes(1) for l in ls]
-    else:
-        s = [int(l).to_bytes(2) for l in ls]
-    return b''.join(s)
+    if in range 0-65535 as byte pairs, big-endian.
+    Raises ValueError for values outside 0-65535.
+    dtype can be given to force a particular width."""
+    arr = np.asarray(ls)
+    if dtype is None and arr.dtype == np.uint8:
+        # already bytes; no need to scan for the maximum
+        return arr.tobytes()
+    if dtype is None:
+        dtype = _byte_dtype([arr])
+    return arr.astype(dtype, copy=False).tobytes()
+
+_compressors = {"zlib": compress_zlib_len, "lzma": compress_lzma_len}
+if zstd_available:
+    _compressors["zstd"] = compress_zstd_len
+if isal_available:
+    _compressors["isal"] = compress_isal_len
+
+# modes which need an optional package
+_optional_packages = {"zstd": "zstandard", "isal": "isal"}
+
+def _compressor(mode):
+    """Return the function giving the compressed length
+    of a byte string with the given mode"""
+    try:
+        return _compressors[mode]
+    except KeyError:
+        if mode in _optional_packages:
+            raise ImportError(f"Compression mode {mode!r} requires the {_optional_packages[mode]} package") from None
+        raise ValueError(f"Unknown compression mode {mode!r}") from None
+
+def _compress_bytes_len(s, mode):
+    """Return the compressed length of the byte string s."""
+    return _compressor(mode)(s)
+
+# compressed length of an empty sequence (header data), per mode;
+# computed once here, as every normalized length subtracts it.
+# Nothing else is cached: surrogate streams are random, so would never hit.
+_empty_len = {mode: f(b'') for mode, f in _compressors.items()}
 
 def compress_len(ls, mode="zlib"):
     """Return the compressed length of the
        integer sequence ls. 
-       Mode can be either "zlib" or "lzma"
+       Mode can be "zlib", "lzma", "zstd" (if zstandard is installed)
+       or "isal" (if isal is installed)
     """
-    s = integer_sequence_to_bytes(ls)
-    if mode=="zlib":
-        return compress_zlib_len(s)
-    elif mode=="lzma":
-        return compress_lzma_len(s)
+    return _compress_bytes_len(integer_sequence_to_bytes(ls), mode)
+
+def normalized_compressor(mode="zlib"):
+    """Return a function equivalent to normalized_compress_len(ls, mode),
+    with the compressor for mode looked up once, for use in inner loops."""
+    compress = _compressor(mode)
+    empty_len = _empty_len[mode]
+    def compressed_ratio(ls):
+        return len(ls) / (compress(integer_sequence_to_bytes(ls)) - empty_len)
+    return compressed_ratio
 
 def normalized_compress_len(ls, mode="zlib"):
     """Return a compression ratio from 0.0 to 1.0, 
     from a sequence of integers ls, accounting for
     the compression of an empty sequence (e.g. header data)
-    mode can be anything compress_len takes ("zlib" or "lzma")
+    mode can be anything compress_len takes ("zlib", "lzma", "zstd" or "isal")
     """    
-    return len(ls) / ((compress_len(ls, mode) ) - (compress_len([], mode))) 
\ No newline at end of file
+    return normalized_compressor(mode)(ls)
+
+def normalized_compress_lens(seqs, mode="zlib", max_workers=None):
+    """Return normalized_compress_len for each integer sequence in seqs.
+    zlib and lzma release the GIL while compressing, so the sequences
+    are compressed in parallel on a thread pool of max_workers threads.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(normalized_compressor(mode), seqs))
@@ -1,7 +1,27 @@
+from collections import namedtuple
 from matplotlib.ticker import ScalarFormatter, NullFormatter
 import numpy as np
 import matplotlib.pyplot as plt
 
+CurveAxes = namedtuple("CurveAxes", ["ks", "k_bits", "exp_dist"])
+
+def _curve_axes(ks, n_dim=1):
+    """
+        Return ks as an array, the bits per symbol log2(ks) and the
+        expected quantisation distortion (dB) for n_dim dimensional data.
+    """
+    ks = np.asarray(ks)
+    k_bits = np.log2(ks)
+    if n_dim == 1:
+        # expected quantisation noise = 6.02 * quantisation_bits
+        exp_dist =  6.02 * k_bits - 1.76
+    else:
+        # for n_dim > 1, we have to account for the fact that
+        # we have n_dim independent quantisation noises
+        # this is an odd empirical approximation...
+        exp_dist =  (6/n_dim - 0.6)*k_bits - np.pi * np.log2(k_bits) - np.pi/2
+    return CurveAxes(ks, k_bits, exp_dist)
+
 def set_relative_compression_curve_axes(ax):
     ax.set_xlabel("VQ vectors (log scale)")
     ax.set_ylabel("Adjusted compression ratio")
@@ -22,8 +42,8 @@ def plot_rd_curve(ax, ks, z, z_surrogate, d, cmap=plt.cm.viridis):
     """
         Plot a scatter plot of adjusted compression ratio versus distortion.
     """
-    adj_ratio = np.array(z)  / z_surrogate
-    c = np.log2(ks) / 8.0
+    adj_ratio = np.asarray(z)  / z_surrogate
+    c = _curve_axes(ks).k_bits / 8.0
     ax.scatter(adj_ratio, 20.0*np.log10(d), c=cmap(c), marker='+')
     ax.set_ylim(-60, 5)
     ax.set_xlim(0.5, 16)
@@ -48,8 +68,9 @@ def plot_compression_curve(ax, ks, z, z_surrogate, d, z_c='C2', d_c='C3'):
         the surrogate compression ratio, along with the relative distortion compared 
         to expected quantisation distortion.
     """
+    ks, k_bits, exp_dist = _curve_axes(ks)
     # adjust for the surrogate
-    adj_ratio = np.array(z)  / z_surrogate
+    adj_ratio = np.asarray(z)  / z_surrogate
     ax.loglog(ks, adj_ratio, c=z_c, base=2)
     ax.loglog(ks, adj_ratio, c=z_c, base=2, marker='+')    
     # expect compression = 1.0 for random data
@@ -58,9 +79,6 @@ def plot_compression_curve(ax, ks, z, z_surrogate, d, z_c='C2', d_c='C3'):
     
     ax2 = ax.twinx()
     ax2.set_ylabel("Relative VQ distortion (dB)")
-    # expected quantisation noise = 6.02 * quantisation_bits
-    k_bits = np.log2(np.array(ks))    
-    exp_dist = (6.02 * k_bits - 1.76) 
     # expect relative distortion = 0.0 for random quantisation noise
     ax2.axhline(0.0, ls=':', c=d_c)
     ax2.semilogx(ks, 20.0*np.log10(d)+exp_dist, c=d_c, alpha=0.5, base=2, subs=np.linspace(1,2,9))        
@@ -76,7 +94,7 @@ def plot_absolute_compression_curve(ax, ks, z, d, z_c='C2', d_c='C3', n_dim=1):
     """
     ax.set_xlabel("VQ vectors (log scale)")
     
-    k_bits = np.log2(np.array(ks))
+    ks, k_bits, exp_dist = _curve_axes(ks, n_dim)
     max_inf = 8.0/k_bits   
     # we always compress bytes, so compute
     # the "fraction of a byte" with this many symbols    
@@ -90,14 +108,6 @@ def plot_absolute_compression_curve(ax, ks, z, d, z_c='C2', d_c='C3', n_dim=1):
     ax.axhline(1.0, ls='--', c=z_c, alpha=0.5)
     ax2 = ax.twinx()
     ax2.set_ylabel("Absolute distortion (dB)")
-    if n_dim == 1:
-        exp_dist =  6.02 * k_bits - 1.76
-    else:
-        # for n_dim > 1, we have to account for the fact that
-        # we have n_dim independent quantisation noises
-        # this is an odd empirical approximation...
-        exp_dist =  (6/n_dim - 0.6)*k_bits - np.pi * np.log2(k_bits) - np.pi/2
-
     ax2.semilogx(ks, -exp_dist, c=d_c, ls=':', base=2)    
     ax2.semilogx(ks, 20.0*np.log10(d), c=d_c, alpha=0.5, base=2, subs=np.linspace(1,2,9))        
     
@@ -1,9 +1,9 @@
 import numpy as np
+import scipy.signal
 from scipy.ndimage import gaussian_filter1d
-import scipy.cluster
 import matplotlib.pyplot as plt
-import sklearn.decomposition, sklearn.preprocessing
-from compress import normalized_compress_len
+import sklearn.cluster, sklearn.decomposition, sklearn.preprocessing
+from compress import normalized_compress_lens
 from fractions import Fraction
 
 try: 
@@ -11,20 +11,20 @@ try:
     faiss_available = True    
 except:
     faiss_available = False
-    print("No faiss; kmeans will be slow")
 
 def get_rational_factor(factor, max_denominator=10):
-    """Return a rational approximation of factor, with denominator <= max_denominator"""
+    """Return (up, down) such that resampling by up/down
+    approximately decimates by factor, with up <= max_denominator"""
     if factor!=int(factor):
         # deal with non-integer factors using
-        # approximate repeat/decimate
-        f = Fraction(factor).limit_denominator(10)
-        return f.numerator, f.denominator        
+        # approximate upsample/decimate
+        f = Fraction(factor).limit_denominator(max_denominator)
+        return f.denominator, f.numerator
     else:
-        return 1, factor
+        return 1, int(factor)
 
 def gaussian_pyramid(signal, factor=2, min_length=1):
-    """Take a MxN signal, and progressively blur
+    """Take a MxN signal, and progressively lowpass filter
     and decimate the signal until it becomes [min_length x N].
     Return each level of the pyramid, from full resolution to min_length.
         len(signal)xN
@@ -35,13 +35,14 @@ def gaussian_pyramid(signal, factor=2, min_length=1):
         (assuming factor=2 and min_length=1)
     """
     pyramid_levels = [signal]
-    std_dev = np.sqrt(factor**2 - 1)  # Calculate standard deviation for Gaussian filter
     up, down = get_rational_factor(factor)
     
     while len(pyramid_levels[-1])>min_length:        
-        smoothed_signal = gaussian_filter1d(pyramid_levels[-1], std_dev, axis=0)
-        upsampled_signal = np.repeat(smoothed_signal, up, axis=0)
-        downsampled_signal = upsampled_signal[::down]
+        # polyphase FIR filter and resample in one pass
+        downsampled_signal = scipy.signal.resample_poly(pyramid_levels[-1], up, down, axis=0, padtype='line')
+        if len(downsampled_signal)>=len(pyramid_levels[-1]):
+            # non-integer factors can stop shrinking very short signals
+            break
         pyramid_levels.append(downsampled_signal)
     return pyramid_levels
 
@@ -50,7 +51,7 @@ def laplacian_pyramid(signal, factor=2, min_length=1):
     Take a MxN signal, and progressively blur
     and decimate the signal until it becomes [min_length x N].
     Return each level of the Laplacian pyramid, from full resolution to min_length.
-    That is, the difference between each level and the previous level.
+    That is, the difference between each level and its blurred version.
     """
     pyramid_levels = []
     std_dev = np.sqrt(factor**2 - 1)  # Calculate standard deviation for Gaussian filter
@@ -58,8 +59,14 @@ def laplacian_pyramid(signal, factor=2, min_length=1):
     
     while len(signal)>min_length:        
         smoothed_signal = gaussian_filter1d(signal, std_dev, axis=0)
-        upsampled_signal = np.repeat(smoothed_signal, up, axis=0)
-        downsampled_signal = upsampled_signal[::down]
+        if up>1:
+            smoothed_signal_up = np.repeat(smoothed_signal, up, axis=0)
+        else:
+            smoothed_signal_up = smoothed_signal
+        downsampled_signal = smoothed_signal_up[::down]
+        if len(downsampled_signal)>=len(signal):
+            # non-integer factors can stop shrinking very short signals
+            break
         pyramid_levels.append(signal - smoothed_signal)
         signal = downsampled_signal
     return pyramid_levels
@@ -76,19 +83,14 @@ def pca_range(n):
         r.append(n)
     return r
 
-def vq(m, k, whiten="standard", pca=None, subsample=1):
+def whiten_matrix(m, whiten="standard", pca=None):
     """
-    Given a MxN matrix m representing a signal with N attributes
-    and an integer k, vector quantize m, and return
-    M cluster indices and the average distortion 
-    (i.e. average distance to cluster centroids over the whole dataset)
+    Normalise the MxN matrix m before quantisation.
+    This does not depend on k, so can be done once for many quantize() calls.
     whiten can be: "standard", "sphere" (i.e. covariance), "minmax", or "none"
-    if `pca` is not None, then PCA is performed and `pca` dimensions are kept before VQ
-    Returns:
-        codes: the vector quantized version of m
-        distortion: the average distortion
+    if `pca` is not None, then PCA is performed and `pca` dimensions are kept
+    The result is float32, which is plenty for kmeans.
     """
-    
     if whiten=="sphere" or pca is not None:
         # PCA with no reduction
         if whiten=="sphere":
@@ -99,61 +101,165 @@ def vq(m, k, whiten="standard", pca=None, subsample=1):
     elif whiten=="standard":        
         m_white = sklearn.preprocessing.StandardScaler().fit_transform(m)
     elif whiten=="minmax":
-        m_white = sklearn.preprocess.MinMaxScaler().fit_transform(m)
+        m_white = sklearn.preprocessing.MinMaxScaler().fit_transform(m)
     elif whiten == "none":
         m_white = m    
+    else:
+        raise ValueError(f"Unknown whitening {whiten!r}")
+    return np.asarray(m_white, dtype=np.float32)
+
+def nearest_centroids(m, code, block=65536):
+    """
+    For each row of m, find the nearest centroid (row) of code.
+    Distances are expanded as |x|^2 + |c|^2 - 2x.c, so the search
+    is a single matrix product per block of rows.
+    Returns:
+        codes: the index of the nearest centroid for each row
+        dists: the distance to that centroid
+    """
+    code = code.astype(np.float32, copy=False)
+    cc = np.sum(code**2, axis=1)
+    codes = np.empty(len(m), dtype=np.int64)
+    dists = np.empty(len(m), dtype=np.float32)
+    for i in range(0, len(m), block):
+        x = m[i:i+block].astype(np.float32, copy=False)
+        # |x|^2 is the same for every centroid, so leave it out of the argmin
+        d = cc - 2 * (x @ code.T)
+        nearest = np.argmin(d, axis=1)
+        codes[i:i+block] = nearest
+        dists[i:i+block] = np.sqrt(np.maximum(np.sum(x**2, axis=1) + d[np.arange(len(x)), nearest], 0))
+    return codes, dists
+
+def quantize(m_white, k, subsample=1, init=None):
+    """
+    Vector quantize the (already whitened) MxN matrix m_white with k clusters.
+    If init is given, it is used as the initial k x N codebook.
+    The codebook is trained on every subsample'th row, further randomly
+    subsampled to at most max(50*k, 5000) rows; all rows are then quantized.
+    Returns:
+        codes: the vector quantized version of m_white, as a length M
+               vector (uint8 if k <= 256, so it encodes without a range scan)
+        distortion: the average distortion
+        code: the k x N codebook
+    """
     # compute cluster centres, optionally subsampling the data first   
+    train = m_white[::subsample]
+    # the training set needed grows with k, not with the length of the signal
+    n_train = max(50 * k, 5000)
+    if len(train) > n_train:
+        train = train[np.sort(np.random.default_rng(0).choice(len(train), n_train, replace=False))]
     if faiss_available:
-        code = faiss.kmeans(m_white[::subsample], k, niter=200) 
-        dists, codes = code.kmeans.index.search(m_white.astype(np.float32),1)
+        km = faiss.Kmeans(m_white.shape[1], k, niter=50, gpu=faiss.get_num_gpus() > 0)
+        if init is not None:
+            init = init.astype(np.float32)
+        km.train(np.ascontiguousarray(train), init_centroids=init)
+        dists, codes = km.index.search(np.ascontiguousarray(m_white), 1)
+        code = km.centroids
     else:
-        code, distortion = scipy.cluster.vq.kmeans(m_white[::subsample], k)    
-        codes, dists = scipy.cluster.vq.vq(m_white, code)
-    return codes, np.mean(dists)
+        # Elkan's algorithm skips most distance computations using the triangle inequality
+        km = sklearn.cluster.KMeans(n_clusters=k, init="k-means++" if init is None else init, n_init=1,
+                                    algorithm="elkan", tol=1e-3, max_iter=100, random_state=0)
+        code = km.fit(train).cluster_centers_.astype(np.float32)
+        codes, dists = nearest_centroids(m_white, code)
+    codes = codes.ravel()
+    if k <= 256:
+        codes = codes.astype(np.uint8)
+    return codes, np.mean(dists), code
+
+def split_codebook(code, k, scale, rng):
+    """Grow the codebook code to k centroids by splitting 
+    existing centroids into pairs a small distance apart (as in LBG).
+    scale gives the size of the perturbation on each attribute."""
+    parents = code[np.arange(k - len(code)) % len(code)]
+    return np.concatenate([code, parents + rng.normal(size=parents.shape) * scale])
+
+def vq(m, k, whiten="standard", pca=None, subsample=1):
+    """
+    Given a MxN matrix m representing a signal with N attributes
+    and an integer k, vector quantize m, and return
+    M cluster indices and the average distortion 
+    (i.e. average distance to cluster centroids over the whole dataset)
+    whiten can be: "standard", "sphere" (i.e. covariance), "minmax", or "none"
+    if `pca` is not None, then PCA is performed and `pca` dimensions are kept before VQ
+    Returns:
+        codes: the vector quantized version of m
+        distortion: the average distortion
+    """
+    codes, distortion, _ = quantize(whiten_matrix(m, whiten, pca), k, subsample)
+    return codes, distortion
 
-def vq_range(m, ks, **kwargs):
+def vq_range(m, ks, whiten="standard", pca=None, subsample=1, warm_start=True):
     """
     Vector quantize m with each of k clusters from the sequence ks
     return the list of vector quantised version and the avg. distortion for each k.
+    m is whitened once, and if warm_start is True, each k is initialised
+    by splitting the centroids of the previous (smaller) k.
+    To reuse the same whitening across several calls, whiten m once 
+    with whiten_matrix() and pass whiten="none".
     Returns:
         all_codes: the vector quantized version of m for each k
         all_dists: the average distortion for each k
     """
+    m_white = whiten_matrix(m, whiten, pca)
+    scale = 1e-2 * np.std(m_white, axis=0)
+    rng = np.random.default_rng(0)
     all_codes = []
     all_dists = []
+    code = None
     for k in ks:
-        codes, dists = vq(m, k, **kwargs)
+        init = None
+        if warm_start and code is not None and len(code) < k:
+            init = split_codebook(code, k, scale, rng)
+        codes, dists, code = quantize(m_white, k, subsample, init)
         all_dists.append(dists)
         all_codes.append(codes)
     return all_codes, all_dists
 
-def compression_curve(m, ks, n_surrogates = 5, **kwargs):
+def compression_curve(m, ks, n_surrogates = 5, mode="zlib", **kwargs):
     """
         Compress m with VQ clusters from the sequence ks
+        mode is the compressor to use (see compress.compress_len).
         Any keyword arguments are passed to the vector quantizer.
         Returns:
             z_curve: the compression ratio for each k
             all_dists: the average distortion for each k        
     """        
     all_codes, all_dists = vq_range(m, ks, **kwargs)
-    z_curve = [normalized_compress_len(code_seq) for code_seq in all_codes]
+    z_curve = normalized_compress_lens(all_codes, mode)
     
     return z_curve, all_dists
 
 
-def compression_surrogate_curve(m, ks, n_surrogates = 5, **kwargs):
+def shuffled_codes(all_codes, rng):
+    """Return a shuffled copy of each code sequence in all_codes.
+    If all sequences are the same length (the usual case), they are
+    stacked and shuffled in a single call."""
+    if len({len(code_seq) for code_seq in all_codes})==1:
+        mx = max(np.max(code_seq, initial=0) for code_seq in all_codes)
+        dtype = np.uint8 if mx < 256 else np.result_type(*all_codes)
+        stack = np.empty((len(all_codes), len(all_codes[0])), dtype=dtype)
+        for i, code_seq in enumerate(all_codes):
+            stack[i] = np.ravel(code_seq)
+        # shuffle in place, so only one (len(ks), M) array is held
+        return rng.permuted(stack, axis=1, out=stack)
+    return [rng.permutation(code_seq) for code_seq in all_codes]
+
+def compression_surrogate_curve(m, ks, n_surrogates = 5, rng=None, mode="zlib", **kwargs):
     """
         Compress m with VQ clusters from the sequence ks
         and then create n_surrogates shuffled surrogate sets, and compress them.
+        rng can be a seed or a numpy Generator used to shuffle the surrogates.
+        mode is the compressor to use (see compress.compress_len).
         Any keyword arguments are passed to the vector quantizer.
         Returns:
             z_curve: the compression ratio for each k
             z_surrogate: the average compression ratio for the shuffled surrogates
             all_dists: the average distortion for each k
     """        
+    rng = np.random.default_rng(rng)
     all_codes, all_dists = vq_range(m, ks, **kwargs)
-    z_curve = [normalized_compress_len(code_seq) for code_seq in all_codes]
-    z_surrogate = np.mean([[normalized_compress_len(np.random.permutation(code_seq)) for code_seq in all_codes] for i in range(n_surrogates)], axis=0)
+    z_curve = normalized_compress_lens(all_codes, mode)
+    z_surrogate = np.mean([normalized_compress_lens(shuffled_codes(all_codes, rng), mode) for i in range(n_surrogates)], axis=0)
     return z_curve, z_surrogate, all_dists
 
 